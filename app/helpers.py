@@ -1,3 +1,9 @@
+import logging
+import os
+import secrets
+import time
+
+from itsdangerous import BadSignature, TimestampSigner
 from passlib.context import CryptContext
 
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
@@ -9,3 +15,52 @@ def hash_password(password: str) -> str:
 
 def verify_password(plain: str, hashed: str) -> bool:
     return pwd_context.verify(plain, hashed)
+
+
+logger = logging.getLogger(__name__)
+
+SESSION_MAX_AGE = 86400  # seconds a login cookie stays valid
+SECRET_KEY_FILE = "./.vinnodrive_secret_key"  # kept next to vinnodrive.db
+
+
+def load_secret_key() -> str:
+    """Return VINNODRIVE_SECRET_KEY, or a generated key shared through SECRET_KEY_FILE."""
+    key = os.environ.get("VINNODRIVE_SECRET_KEY")
+    if key:
+        return key
+
+    logger.warning("VINNODRIVE_SECRET_KEY is not set; using the key stored in %s", SECRET_KEY_FILE)
+    try:
+        # O_EXCL so that only the first worker to start writes the key
+        fd = os.open(SECRET_KEY_FILE, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    except FileExistsError:
+        for _ in range(50):
+            with open(SECRET_KEY_FILE) as f:
+                key = f.read().strip()
+            if key:
+                return key
+            # The worker that created the file hasn't finished writing it yet
+            time.sleep(0.1)
+        raise RuntimeError(f"{SECRET_KEY_FILE} is empty; delete it or set VINNODRIVE_SECRET_KEY")
+
+    key = secrets.token_urlsafe(32)
+    with os.fdopen(fd, "w") as f:
+        f.write(key)
+    return key
+
+
+session_signer = TimestampSigner(load_secret_key())
+
+
+def sign_username(username: str) -> str:
+    return session_signer.sign(username).decode()
+
+
+def unsign_username(token: str | None) -> str | None:
+    """Return the username from a signed session cookie, or None if missing, forged or expired."""
+    if not token:
+        return None
+    try:
+        return session_signer.unsign(token, max_age=SESSION_MAX_AGE).decode()
+    except BadSignature:
+        return None
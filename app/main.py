@@ -1,82 +1,180 @@
-from fastapi import FastAPI, Request, UploadFile, File as FastFile, Form, HTTPException
-from fastapi.responses import HTMLResponse, RedirectResponse, FileResponse
+from fastapi import FastAPI, BackgroundTasks, Depends, Request, UploadFile, File as FastFile, Form, HTTPException
+from fastapi.responses import HTMLResponse, ORJSONResponse, RedirectResponse, FileResponse, Response
 from fastapi.templating import Jinja2Templates
+from cachetools import LRUCache, TTLCache
+from jinja2 import FileSystemBytecodeCache
+from sqlalchemy import delete, exists, func, insert, inspect, select, text, update
+from sqlalchemy.dialects import postgresql, sqlite
 from sqlalchemy.orm import Session
 from typing import List
 import os
+import asyncio
 import hashlib
+import mimetypes
 import secrets
-from datetime import datetime, timedelta
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from urllib.parse import quote
 
 
 from app.database import engine, SessionLocal
 from app import models, helpers
 
 
-app = FastAPI()
+app = FastAPI(default_response_class=ORJSONResponse)
 models.Base.metadata.create_all(bind=engine)
 
 
+
+
+def migrate_legacy_files() -> None:
+    """Upgrade a files table from before the blobs table: add blob_id and point each row at a Blob."""
+    columns = {c["name"] for c in inspect(engine).get_columns("files")}
+
+    with engine.begin() as conn:
+        if "blob_id" not in columns:
+            conn.execute(text("ALTER TABLE files ADD COLUMN blob_id INTEGER REFERENCES blobs(id)"))
+        if "file_hash" not in columns:
+            return
+
+        # One Blob per distinct old hex hash; the blob keeps its on-disk name
+        legacy_hashes = conn.execute(text(
+            "SELECT file_hash, MAX(size), COUNT(*) FROM files "
+            "WHERE blob_id IS NULL AND file_hash IS NOT NULL GROUP BY file_hash"
+        )).all()
+        for file_hash, size, refcount in legacy_hashes:
+            hash_bytes = bytes.fromhex(file_hash)
+            blob_id = conn.execute(
+                select(models.Blob.id).where(models.Blob.hash_bytes == hash_bytes)
+            ).scalar()
+            if blob_id is None:
+                blob_id = conn.execute(
+                    insert(models.Blob).values(hash_bytes=hash_bytes, size=size, refcount=refcount)
+                ).inserted_primary_key[0]
+            else:
+                conn.execute(
+                    update(models.Blob)
+                    .where(models.Blob.id == blob_id)
+                    .values(refcount=models.Blob.refcount + refcount)
+                )
+            conn.execute(
+                text("UPDATE files SET blob_id = :blob_id WHERE file_hash = :file_hash AND blob_id IS NULL"),
+                {"blob_id": blob_id, "file_hash": file_hash}
+            )
+
+
+migrate_legacy_files()
+
+
+# create_all() skips tables that already exist, so add any missing indexes
+for table in models.Base.metadata.sorted_tables:
+    for index in table.indexes:
+        index.create(bind=engine, checkfirst=True)
+
+
 templates = Jinja2Templates(directory="templates")
 
 
+# Templates only change on deploy: skip per-render mtime checks and reuse compiled bytecode across restarts
+TEMPLATE_CACHE_DIR = ".jinja_cache"
+os.makedirs(TEMPLATE_CACHE_DIR, exist_ok=True)
+templates.env.auto_reload = False
+templates.env.bytecode_cache = FileSystemBytecodeCache(TEMPLATE_CACHE_DIR)
+
+
 UPLOAD_DIR = "storage/blobs"
 os.makedirs(UPLOAD_DIR, exist_ok=True)
 
 
 # Configuration
+UPLOAD_CHUNK_SIZE = 1024 * 1024  # bytes read per chunk while streaming uploads
+STALE_UPLOAD_AGE = 60 * 60  # seconds before a leftover temp upload file is removed
 RATE_LIMIT_CALLS = 2  # API calls per second
 RATE_LIMIT_WINDOW = 1  # seconds
+RATE_LIMIT_RATE = RATE_LIMIT_CALLS / RATE_LIMIT_WINDOW  # tokens refilled per second
+RATE_LIMIT_CAPACITY = RATE_LIMIT_CALLS  # maximum burst size
+RATE_LIMIT_SWEEP_INTERVAL = 60  # seconds between sweeps of idle rate limit buckets
 STORAGE_QUOTA_MB = 10  # MB per user (configurable)
 
+# When served behind nginx, set to the internal location that aliases UPLOAD_DIR (e.g. "/blobs/")
+# so downloads are handed off with X-Accel-Redirect instead of streamed through Python
+ACCEL_REDIRECT_PREFIX = os.environ.get("VINNODRIVE_ACCEL_REDIRECT_PREFIX")
+
+
+# In-memory token buckets: (username, endpoint) -> (tokens, last_refill)
+_rate_limit_buckets: dict[tuple[str, str], tuple[float, float]] = {}
+_rate_limit_lock = threading.Lock()
+
+
+# Remembers whether a user already has a file with a given content digest: (username, digest) -> bool
+SEEN_HASH_CACHE_SIZE = 100_000
+_seen_hash_cache: LRUCache = LRUCache(maxsize=SEEN_HASH_CACHE_SIZE)
+_seen_hash_lock = threading.Lock()
+
+
+# Short-lived caches for the upload page's share dropdown and folder list
+LOOKUP_CACHE_TTL = 30  # seconds
+_usernames_cache: TTLCache = TTLCache(maxsize=1, ttl=LOOKUP_CACHE_TTL)
+_folder_names_cache: TTLCache = TTLCache(maxsize=10_000, ttl=LOOKUP_CACHE_TTL)
+_lookup_cache_lock = threading.Lock()
+
 
 
 
 def get_db():
     db = SessionLocal()
     try:
-        return db
+        yield db
     finally:
         db.close()
 
 
 
 
-def check_rate_limit(username: str, endpoint: str, db: Session) -> bool:
+def check_rate_limit(username: str, endpoint: str) -> bool:
     """Check if user has exceeded rate limit. Returns True if allowed, False if blocked."""
-    now = datetime.utcnow()
-    window_start = now - timedelta(seconds=RATE_LIMIT_WINDOW)
-   
-    # Count requests in the time window
-    recent_requests = db.query(models.RateLimit).filter(
-        models.RateLimit.username == username,
-        models.RateLimit.endpoint == endpoint,
-        models.RateLimit.timestamp >= window_start
-    ).count()
-   
-    if recent_requests >= RATE_LIMIT_CALLS:
-        return False
-   
-    # Log this request
-    db.add(models.RateLimit(username=username, endpoint=endpoint, timestamp=now))
-    db.commit()
-   
-    # Clean up old entries (older than 1 minute)
-    cleanup_time = now - timedelta(minutes=1)
-    db.query(models.RateLimit).filter(models.RateLimit.timestamp < cleanup_time).delete()
-    db.commit()
-   
+    key = (username, endpoint)
+    now = time.monotonic()
+
+    with _rate_limit_lock:
+        tokens, last_refill = _rate_limit_buckets.get(key, (RATE_LIMIT_CAPACITY, now))
+
+        # Refill tokens for the time elapsed since the last request
+        tokens = min(RATE_LIMIT_CAPACITY, tokens + (now - last_refill) * RATE_LIMIT_RATE)
+        if tokens < 1:
+            _rate_limit_buckets[key] = (tokens, now)
+            return False
+
+        _rate_limit_buckets[key] = (tokens - 1, now)
+
     return True
 
 
 
 
-def check_storage_quota(username: str, file_size: int, db: Session) -> tuple[bool, str]:
+def sweep_rate_limit_buckets() -> None:
+    """Drop buckets that have refilled to capacity, since they behave exactly like missing ones."""
+    now = time.monotonic()
+    with _rate_limit_lock:
+        for key, (tokens, last_refill) in list(_rate_limit_buckets.items()):
+            if tokens + (now - last_refill) * RATE_LIMIT_RATE >= RATE_LIMIT_CAPACITY:
+                del _rate_limit_buckets[key]
+
+
+
+
+async def sweep_rate_limit_buckets_periodically() -> None:
+    while True:
+        await asyncio.sleep(RATE_LIMIT_SWEEP_INTERVAL)
+        sweep_rate_limit_buckets()
+
+
+
+
+def check_storage_quota(user: models.User, file_size: int) -> tuple[bool, str]:
     """Check if user has enough storage quota. Returns (allowed, error_message)."""
-    user = db.query(models.User).filter_by(username=username).first()
-    if not user:
-        return False, "User not found"
-   
     if user.storage_used + file_size > user.storage_quota:
         quota_mb = user.storage_quota / (1024 * 1024)
         used_mb = user.storage_used / (1024 * 1024)
@@ -87,6 +185,283 @@ def check_storage_quota(username: str, file_size: int, db: Session) -> tuple[boo
 
 
 
+def new_content_hasher():
+    """Hasher used for content-addressed blob names (dedup key, not a security boundary)."""
+    return hashlib.blake2b(digest_size=32)
+
+
+
+
+def get_blob_path(blob_hash: str) -> str:
+    # Two levels of fanout keep each directory small even with millions of blobs
+    return os.path.join(UPLOAD_DIR, blob_hash[:2], blob_hash[2:4], blob_hash)
+
+
+
+
+def remove_stale_uploads() -> None:
+    """Delete temp upload files left in UPLOAD_DIR by requests that died mid-upload."""
+    # Only old files, so uploads in progress in other workers are left alone
+    cutoff = time.time() - STALE_UPLOAD_AGE
+    with os.scandir(UPLOAD_DIR) as entries:
+        for entry in entries:
+            if not entry.is_file() or not entry.name.endswith(".tmp"):
+                continue
+            try:
+                if entry.stat().st_mtime < cutoff:
+                    discard_tmp_file(entry.path)
+            except FileNotFoundError:
+                # Another worker got to it first
+                continue
+
+
+
+
+def migrate_flat_blobs() -> None:
+    """Move blobs stored directly in UPLOAD_DIR by older versions into their fanout directories."""
+    with os.scandir(UPLOAD_DIR) as entries:
+        for entry in entries:
+            if not entry.is_file() or len(entry.name) != 64:
+                continue
+            blob_path = get_blob_path(entry.name)
+            os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+            try:
+                os.replace(entry.path, blob_path)
+            except FileNotFoundError:
+                # Every worker runs this at startup; another one already moved it
+                continue
+
+
+
+
+def stream_upload_to_disk(upload: UploadFile) -> tuple[str, bytes, int]:
+    """Stream an upload into a temp file in UPLOAD_DIR, hashing as it goes. Returns (tmp_path, digest, size)."""
+    hasher = new_content_hasher()
+    size = 0
+
+    with tempfile.NamedTemporaryFile(dir=UPLOAD_DIR, suffix=".tmp", delete=False) as tmp:
+        try:
+            while chunk := upload.file.read(UPLOAD_CHUNK_SIZE):
+                hasher.update(chunk)
+                tmp.write(chunk)
+                size += len(chunk)
+        except BaseException:
+            tmp.close()
+            discard_tmp_file(tmp.name)
+            raise
+
+    return tmp.name, hasher.digest(), size
+
+
+
+
+def discard_tmp_file(tmp_path: str) -> None:
+    try:
+        os.unlink(tmp_path)
+    except FileNotFoundError:
+        pass
+
+
+
+
+def place_blob(tmp_path: str, blob_path: str) -> bool:
+    """Move a streamed upload into place as its blob. Returns True if the blob is new."""
+    # Always replace, even if the blob exists: a concurrent delete may be about to remove
+    # that copy. Atomic, so readers see either the old or new (identical) bytes.
+    os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+    created = not os.path.exists(blob_path)
+    os.replace(tmp_path, blob_path)
+    return created
+
+
+
+
+def fsync_blob(blob_path: str) -> None:
+    """Flush a placed blob and its directory entry to stable storage (runs after the upload response)."""
+    # The blob may already have been deleted again by the time this runs
+    for path in (blob_path, os.path.dirname(blob_path)):
+        try:
+            fd = os.open(path, os.O_RDONLY)
+        except FileNotFoundError:
+            return
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+
+
+
+def blob_response(request: Request, blob: models.Blob, file: models.File) -> Response:
+    """Serve a blob, using its content hash as an ETag so repeat downloads get a 304."""
+    blob_hash = blob.hash_bytes.hex()
+    blob_path = get_blob_path(blob_hash)
+    if not os.path.exists(blob_path):
+        raise HTTPException(status_code=404)
+
+    # The ETag is the content hash, but download URLs use file ids, which SQLite can
+    # reuse after a delete, so browsers must revalidate rather than cache forever
+    headers = {
+        "ETag": f'"{blob_hash}"',
+        "Cache-Control": "private, no-cache"
+    }
+
+    if_none_match = request.headers.get("if-none-match", "")
+    if headers["ETag"] in [tag.strip() for tag in if_none_match.split(",")]:
+        return Response(status_code=304, headers=headers)
+
+    if ACCEL_REDIRECT_PREFIX:
+        blob_name = os.path.relpath(blob_path, UPLOAD_DIR).replace(os.sep, "/")
+        quoted_filename = quote(file.filename)
+        if quoted_filename != file.filename:
+            headers["Content-Disposition"] = f"attachment; filename*=utf-8''{quoted_filename}"
+        else:
+            headers["Content-Disposition"] = f'attachment; filename="{file.filename}"'
+        headers["X-Accel-Redirect"] = ACCEL_REDIRECT_PREFIX.rstrip("/") + "/" + blob_name
+        return Response(headers=headers, media_type=mimetypes.guess_type(file.filename)[0])
+
+    return FileResponse(blob_path, filename=file.filename, headers=headers)
+
+
+
+
+def increment_download_count(share_id: int) -> None:
+    """Atomically bump a share's download counter (runs after the download response)."""
+    db = SessionLocal()
+    try:
+        db.execute(
+            update(models.Share)
+            .where(models.Share.id == share_id)
+            .values(download_count=models.Share.download_count + 1)
+        )
+        db.commit()
+    finally:
+        db.close()
+
+
+
+
+# INSERT constructs supporting on_conflict_do_nothing(), by database dialect
+ON_CONFLICT_INSERTS = {
+    "sqlite": sqlite.insert,
+    "postgresql": postgresql.insert,
+}
+
+
+
+
+def reference_blobs(sizes: dict[bytes, int], refcount_deltas: dict[bytes, int], db: Session) -> dict[bytes, int]:
+    """Ensure a Blob row exists for each digest and add to its refcount. Returns {digest: blob_id}."""
+    blob_ids = {}
+    pending = dict(refcount_deltas)
+    while pending:
+        # Concurrent uploads of the same new content must not trip the unique constraint
+        dialect_insert = ON_CONFLICT_INSERTS[db.get_bind().dialect.name]
+        db.execute(
+            dialect_insert(models.Blob)
+            .values([{"hash_bytes": digest, "size": sizes[digest], "refcount": 0} for digest in pending])
+            .on_conflict_do_nothing(index_elements=["hash_bytes"])
+        )
+        existing_ids = dict(
+            db.query(models.Blob.hash_bytes, models.Blob.id).filter(models.Blob.hash_bytes.in_(pending))
+        )
+
+        for digest in list(pending):
+            blob_id = existing_ids.get(digest)
+            if blob_id is None:
+                continue
+            result = db.execute(
+                update(models.Blob)
+                .where(models.Blob.id == blob_id)
+                .values(refcount=models.Blob.refcount + pending[digest])
+            )
+            # No row updated means a delete removed the blob in between, so insert it again
+            if result.rowcount:
+                blob_ids[digest] = blob_id
+                del pending[digest]
+
+    return blob_ids
+
+
+
+
+def seen_digests(username: str, digests: list[bytes], db: Session) -> set[bytes]:
+    """Return which content digests the user already has, consulting the seen-hash cache first."""
+    seen = set()
+    misses = []
+    with _seen_hash_lock:
+        for digest in digests:
+            cached = _seen_hash_cache.get((username, digest))
+            if cached is None:
+                misses.append(digest)
+            elif cached:
+                seen.add(digest)
+
+    if not misses:
+        return seen
+
+    user_digests = {
+        h for (h,) in db.query(models.Blob.hash_bytes).join(
+            models.File, models.File.blob_id == models.Blob.id
+        ).filter(
+            models.File.uploader == username,
+            models.Blob.hash_bytes.in_(misses)
+        )
+    }
+
+    with _seen_hash_lock:
+        for digest in misses:
+            is_seen = digest in user_digests
+            _seen_hash_cache[(username, digest)] = is_seen
+            if is_seen:
+                seen.add(digest)
+    return seen
+
+
+
+
+def get_all_usernames(db: Session) -> list[str]:
+    """Return every username, cached for LOOKUP_CACHE_TTL seconds (invalidated on signup)."""
+    with _lookup_cache_lock:
+        usernames = _usernames_cache.get("all")
+    if usernames is None:
+        usernames = [u for (u,) in db.query(models.User.username)]
+        with _lookup_cache_lock:
+            _usernames_cache["all"] = usernames
+    return usernames
+
+
+
+
+def get_folder_names(username: str, db: Session) -> list[str]:
+    """Return the user's folder names, cached for LOOKUP_CACHE_TTL seconds (invalidated on folder creation)."""
+    with _lookup_cache_lock:
+        folder_names = _folder_names_cache.get(username)
+    if folder_names is None:
+        folder_names = [name for (name,) in db.query(models.Folder.name).filter_by(owner=username)]
+        with _lookup_cache_lock:
+            _folder_names_cache[username] = folder_names
+    return folder_names
+
+
+
+
+# ---------------- STARTUP ----------------
+_startup_tasks: set[asyncio.Task] = set()
+
+
+@app.on_event("startup")
+async def start_housekeeping():
+    migrate_flat_blobs()
+    remove_stale_uploads()
+
+    # Keep a reference so the task isn't garbage collected while it runs
+    task = asyncio.create_task(sweep_rate_limit_buckets_periodically())
+    _startup_tasks.add(task)
+
+
+
+
 # ---------------- HOME ----------------
 @app.get("/")
 def home():
@@ -104,10 +479,7 @@ def signup_page(request: Request):
 
 
 @app.post("/signup")
-def signup(request: Request, username: str = Form(...), password: str = Form(...)):
-    db: Session = get_db()
-
-
+def signup(request: Request, username: str = Form(...), password: str = Form(...), db: Session = Depends(get_db)):
     if db.query(models.User).filter_by(username=username).first():
         return templates.TemplateResponse(
             "signup.html",
@@ -124,6 +496,9 @@ def signup(request: Request, username: str = Form(...), password: str = Form(...
     db.add(user)
     db.commit()
 
+    with _lookup_cache_lock:
+        _usernames_cache.clear()
+
 
     return RedirectResponse("/login", status_code=302)
 
@@ -139,8 +514,7 @@ def login_page(request: Request):
 
 
 @app.post("/login")
-def login(request: Request, username: str = Form(...), password: str = Form(...)):
-    db: Session = get_db()
+def login(request: Request, username: str = Form(...), password: str = Form(...), db: Session = Depends(get_db)):
     user = db.query(models.User).filter_by(username=username).first()
 
 
@@ -159,7 +533,13 @@ def login(request: Request, username: str = Form(...), password: str = Form(...)
 
 
     response = RedirectResponse("/upload", status_code=302)
-    response.set_cookie(key="user", value=username, path="/", httponly=True)
+    response.set_cookie(
+        key="user",
+        value=helpers.sign_username(username),
+        max_age=helpers.SESSION_MAX_AGE,
+        path="/",
+        httponly=True
+    )
     return response
 
 
@@ -177,15 +557,12 @@ def logout():
 
 # ---------------- UPLOAD PAGE ----------------
 @app.get("/upload", response_class=HTMLResponse)
-def upload_page(request: Request):
-    username = request.cookies.get("user")
+def upload_page(request: Request, db: Session = Depends(get_db)):
+    username = helpers.unsign_username(request.cookies.get("user"))
     if not username:
         return RedirectResponse("/login")
 
 
-    db: Session = get_db()
-
-
     # Get user info
     user = db.query(models.User).filter_by(username=username).first()
     storage_quota_mb = user.storage_quota / (1024 * 1024)
@@ -194,8 +571,7 @@ def upload_page(request: Request):
 
 
     # Get user's folders
-    user_folders = db.query(models.Folder).filter_by(owner=username).all()
-    folder_names = [f.name for f in user_folders]
+    folder_names = get_folder_names(username, db)
 
 
     # Own files
@@ -203,11 +579,14 @@ def upload_page(request: Request):
 
 
     # Calculate storage statistics
-    # Actual storage used (after deduplication) - only count original files
-    actual_storage_used = sum(f.size for f in own_files if not f.is_duplicate)
+    # Actual storage used (after deduplication) - already maintained on the user row
+    actual_storage_used = user.storage_used
    
     # Original size (before deduplication) - count all files
-    original_total_size = sum(f.size for f in own_files)
+    original_total_size, total_files = db.query(
+        func.coalesce(func.sum(models.File.size), 0),
+        func.count(models.File.id)
+    ).filter(models.File.uploader == username).one()
    
     # Savings
     total_savings_bytes = original_total_size - actual_storage_used
@@ -215,51 +594,57 @@ def upload_page(request: Request):
 
 
     # Files shared with user
-    shared_entries = db.query(models.SharedFile).filter_by(shared_with=username).all()
-    shared_files = []
-    for entry in shared_entries:
-        file = db.query(models.File).filter_by(id=entry.file_id).first()
-        if file:
-            shared_files.append({
-                "file": file,
-                "shared_by": entry.shared_by,
-                "shared_at": entry.shared_at
-            })
+    shared_rows = db.query(models.SharedFile, models.File).join(
+        models.File, models.File.id == models.SharedFile.file_id
+    ).filter(models.SharedFile.shared_with == username).all()
+    shared_files = [
+        {
+            "file": file,
+            "shared_by": entry.shared_by,
+            "shared_at": entry.shared_at
+        }
+        for entry, file in shared_rows
+    ]
 
 
-    # Group own files by folder
-    folders_data = {"Root": []}
+    # Group own files by folder (empty folders still get an entry)
+    folders_data = defaultdict(list)
     for f in own_files:
-        folder_name = f.folder if f.folder else "Root"
-        if folder_name not in folders_data:
-            folders_data[folder_name] = []
-        folders_data[folder_name].append(f)
-
-
+        folders_data[f.folder or "Root"].append(f)
     for name in folder_names:
-        if name not in folders_data:
-            folders_data[name] = []
+        folders_data[name]
 
 
     # Sort folders: Root first
-    sorted_folders = {"Root": folders_data["Root"]}
-    for k in sorted([k for k in folders_data if k != "Root"]):
-        sorted_folders[k] = folders_data[k]
+    root_files = folders_data.pop("Root", [])
+    sorted_folders = {"Root": root_files, **{k: folders_data[k] for k in sorted(folders_data)}}
 
 
     # Public share info
+    own_file_ids = [f.id for f in own_files]
+    shares_by_file_id = {
+        share.file_id: share
+        for share in db.query(models.Share).filter(
+            models.Share.file_id.in_(own_file_ids),
+            models.Share.is_active == True
+        )
+    }
+
+
+    # Blobs that have at least one duplicate copy for this user
+    duplicated_blob_ids = {
+        blob_id for (blob_id,) in db.query(models.File.blob_id).filter(
+            models.File.uploader == username,
+            models.File.is_duplicate == True
+        ).distinct()
+    }
+
+
     files_with_shares = []
     for f in own_files:
-        share = db.query(models.Share).filter_by(file_id=f.id, is_active=True).first()
-       
-        has_duplicates = False
-        if not f.is_duplicate:
-            has_duplicates = db.query(models.File).filter_by(
-                uploader=username,
-                file_hash=f.file_hash,
-                is_duplicate=True
-            ).count() > 0
-       
+        share = shares_by_file_id.get(f.id)
+        has_duplicates = not f.is_duplicate and f.blob_id in duplicated_blob_ids
+
         files_with_shares.append({
             "file": f,
             "share_token": share.share_token if share else None,
@@ -269,7 +654,7 @@ def upload_page(request: Request):
 
 
     # All users for sharing
-    all_users = [u.username for u in db.query(models.User).all() if u.username != username]
+    all_users = [u for u in get_all_usernames(db) if u != username]
 
 
     # Get error messages
@@ -277,9 +662,6 @@ def upload_page(request: Request):
     delete_error = request.query_params.get("error")
 
 
-    total_files = len(own_files)
-
-
     return templates.TemplateResponse(
         "upload.html",
         {
@@ -308,78 +690,129 @@ def upload_page(request: Request):
 
 # ---------------- UPLOAD FILE (MULTIPLE FILES SUPPORT) ----------------
 @app.post("/upload")
-def upload_file(request: Request, files: List[UploadFile] = FastFile(...), folder: str = Form(None)):
-    username = request.cookies.get("user")
+def upload_file(request: Request, background_tasks: BackgroundTasks, files: List[UploadFile] = FastFile(...), folder: str = Form(None), db: Session = Depends(get_db)):
+    username = helpers.unsign_username(request.cookies.get("user"))
     if not username:
         return RedirectResponse("/login")
 
 
-    db: Session = get_db()
-
-
     # Rate limiting check
-    if not check_rate_limit(username, "upload", db):
+    if not check_rate_limit(username, "upload"):
         return RedirectResponse("/upload?upload_error=rate_limit", status_code=302)
 
 
-    uploaded_count = 0
-    skipped_count = 0
-   
-    for file in files:
-        content = file.file.read()
-        size = len(content)
-        file_hash = hashlib.sha256(content).hexdigest()
-        blob_path = os.path.join(UPLOAD_DIR, file_hash)
-
-
-        # Check if user already uploaded this file
-        user_has_uploaded_before = db.query(models.File).filter_by(
-            uploader=username,
-            file_hash=file_hash
-        ).first() is not None
-
-
-        # Only count against quota if it's NOT a duplicate for this user
-        if not user_has_uploaded_before:
-            # Check storage quota
-            quota_ok, quota_error = check_storage_quota(username, size, db)
-            if not quota_ok:
-                # Skip this file if quota exceeded
-                skipped_count += 1
-                continue
+    user = db.query(models.User).filter_by(username=username).first()
+    if not user:
+        return RedirectResponse("/login")
 
 
-        # Save blob if doesn't exist globally
-        blob_exists_globally = os.path.exists(blob_path)
-        if not blob_exists_globally:
-            with open(blob_path, "wb") as f:
-                f.write(content)
+    staged = []
+    try:
+        # Stream every file to disk first so the dedup checks are single queries
+        for file in files:
+            staged.append((file, *stream_upload_to_disk(file)))
+        seen = seen_digests(
+            username,
+            [digest for _, _, digest, _ in staged],
+            db
+        )
 
 
         folder_name = folder.strip() if folder else None
+        records = []
+        placements = []
+        added_size = 0
+        skipped_count = 0
+   
+        for file, tmp_path, digest, size in staged:
+            # Check if user already uploaded this file (including earlier in this batch)
+            user_has_uploaded_before = digest in seen
 
 
-        record = models.File(
-            filename=file.filename,
-            uploader=username,
-            size=size,
-            file_hash=file_hash,
-            is_duplicate=user_has_uploaded_before,
-            folder=folder_name
-        )
-        db.add(record)
+            # Only count against quota if it's NOT a duplicate for this user
+            if not user_has_uploaded_before:
+                # Check storage quota
+                quota_ok, quota_error = check_storage_quota(user, added_size + size)
+                if not quota_ok:
+                    # Skip this file if quota exceeded
+                    os.unlink(tmp_path)
+                    skipped_count += 1
+                    continue
 
+                added_size += size
 
-        # Update user's storage usage (only if not duplicate)
-        if not user_has_uploaded_before:
-            user = db.query(models.User).filter_by(username=username).first()
-            user.storage_used += size
 
+            # Moved into place just before commit
+            placements.append((tmp_path, get_blob_path(digest.hex())))
 
-        uploaded_count += 1
 
+            records.append({
+                "filename": file.filename,
+                "uploader": username,
+                "size": size,
+                "digest": digest,
+                "is_duplicate": user_has_uploaded_before,
+                "folder": folder_name
+            })
+            seen.add(digest)
+
+
+        if records:
+            refcount_deltas = {}
+            for record in records:
+                refcount_deltas[record["digest"]] = refcount_deltas.get(record["digest"], 0) + 1
+            blob_ids = reference_blobs(
+                {record["digest"]: record["size"] for record in records},
+                refcount_deltas,
+                db
+            )
+            for record in records:
+                record["blob_id"] = blob_ids[record.pop("digest")]
+
+            db.bulk_insert_mappings(models.File, records)
+
+
+        # Update user's storage usage (only non-duplicates count)
+        if added_size:
+            db.execute(
+                update(models.User)
+                .where(models.User.username == username)
+                .values(storage_used=models.User.storage_used + added_size)
+            )
+
+
+        # Save blobs if they don't exist globally, before the rows pointing at them are visible
+        placed = set()
+        created_blobs = []
+        for tmp_path, blob_path in placements:
+            if blob_path in placed:
+                # Same content uploaded twice in this request
+                discard_tmp_file(tmp_path)
+                continue
+            placed.add(blob_path)
+            if place_blob(tmp_path, blob_path):
+                created_blobs.append(blob_path)
 
-    db.commit()
+
+        db.commit()
+    except BaseException:
+        # Don't leave half-finished uploads behind in UPLOAD_DIR
+        for _, tmp_path, _, _ in staged:
+            discard_tmp_file(tmp_path)
+        raise
+
+
+    # Flushing to stable storage can wait until after the response has been sent
+    for blob_path in created_blobs:
+        background_tasks.add_task(fsync_blob, blob_path)
+
+
+    with _seen_hash_lock:
+        for digest in seen:
+            _seen_hash_cache[(username, digest)] = True
+
+
+    uploaded_count = len(records)
 
 
     # Show appropriate message
@@ -393,17 +826,14 @@ def upload_file(request: Request, files: List[UploadFile] = FastFile(...), folde
 
 # ---------------- CREATE FOLDER ----------------
 @app.post("/create-folder")
-def create_folder(request: Request, folder_name: str = Form(...)):
-    username = request.cookies.get("user")
+def create_folder(request: Request, folder_name: str = Form(...), db: Session = Depends(get_db)):
+    username = helpers.unsign_username(request.cookies.get("user"))
     if not username:
         return RedirectResponse("/login")
 
 
-    db: Session = get_db()
-
-
     # Rate limiting
-    if not check_rate_limit(username, "create-folder", db):
+    if not check_rate_limit(username, "create-folder"):
         return RedirectResponse("/upload?upload_error=rate_limit", status_code=302)
 
 
@@ -420,6 +850,9 @@ def create_folder(request: Request, folder_name: str = Form(...)):
 
     db.add(models.Folder(name=folder_name, owner=username))
     db.commit()
+
+    with _lookup_cache_lock:
+        _folder_names_cache.pop(username, None)
     return RedirectResponse("/upload", status_code=302)
 
 
@@ -427,17 +860,14 @@ def create_folder(request: Request, folder_name: str = Form(...)):
 
 # ---------------- PRIVATE SHARE ----------------
 @app.post("/share-with-user/{file_id}")
-def share_with_user(file_id: int, request: Request, target_user: str = Form(...)):
-    username = request.cookies.get("user")
+def share_with_user(file_id: int, request: Request, target_user: str = Form(...), db: Session = Depends(get_db)):
+    username = helpers.unsign_username(request.cookies.get("user"))
     if not username:
         return RedirectResponse("/login")
 
 
-    db: Session = get_db()
-
-
     # Rate limiting
-    if not check_rate_limit(username, "share-with-user", db):
+    if not check_rate_limit(username, "share-with-user"):
         return RedirectResponse("/upload?upload_error=rate_limit", status_code=302)
 
 
@@ -467,16 +897,18 @@ def share_with_user(file_id: int, request: Request, target_user: str = Form(...)
 
 # ---------------- DOWNLOAD ----------------
 @app.get("/download/{file_id}")
-def download_file(file_id: int, request: Request):
-    username = request.cookies.get("user")
+def download_file(file_id: int, request: Request, db: Session = Depends(get_db)):
+    username = helpers.unsign_username(request.cookies.get("user"))
     if not username:
         return RedirectResponse("/login")
 
 
-    db: Session = get_db()
-    file = db.query(models.File).filter_by(id=file_id).first()
-    if not file:
+    row = db.query(models.File, models.Blob).join(
+        models.Blob, models.Blob.id == models.File.blob_id
+    ).filter(models.File.id == file_id).first()
+    if not row:
         raise HTTPException(status_code=404)
+    file, blob = row
 
 
     # Allow if owner or shared
@@ -486,29 +918,21 @@ def download_file(file_id: int, request: Request):
             raise HTTPException(status_code=403, detail="Access denied")
 
 
-    blob_path = os.path.join(UPLOAD_DIR, file.file_hash)
-    if not os.path.exists(blob_path):
-        raise HTTPException(status_code=404)
-
-
-    return FileResponse(blob_path, filename=file.filename)
+    return blob_response(request, blob, file)
 
 
 
 
 # ---------------- DELETE FILE ----------------
 @app.post("/delete/{file_id}")
-def delete_file(file_id: int, request: Request):
-    username = request.cookies.get("user")
+def delete_file(file_id: int, request: Request, db: Session = Depends(get_db)):
+    username = helpers.unsign_username(request.cookies.get("user"))
     if not username:
         return RedirectResponse("/login")
 
 
-    db: Session = get_db()
-
-
     # Rate limiting
-    if not check_rate_limit(username, "delete", db):
+    if not check_rate_limit(username, "delete"):
         return RedirectResponse("/upload?upload_error=rate_limit", status_code=302)
 
 
@@ -519,17 +943,17 @@ def delete_file(file_id: int, request: Request):
 
     # Check if original with duplicates
     if not file.is_duplicate:
-        duplicate_count = db.query(models.File).filter_by(
-            uploader=username,
-            file_hash=file.file_hash,
-            is_duplicate=True
-        ).count()
+        has_duplicates = db.query(exists().where(
+            models.File.uploader == username,
+            models.File.blob_id == file.blob_id,
+            models.File.is_duplicate == True
+        )).scalar()
        
-        if duplicate_count > 0:
+        if has_duplicates:
             return RedirectResponse("/upload?error=delete_duplicates_first", status_code=302)
 
 
-    blob_path = os.path.join(UPLOAD_DIR, file.file_hash)
+    blob = db.query(models.Blob).filter_by(id=file.blob_id).first()
 
 
     # Update storage usage (only if not duplicate)
@@ -546,15 +970,37 @@ def delete_file(file_id: int, request: Request):
 
 
     db.delete(file)
-    db.commit()
+    db.flush()
+
+
+    # Drop the blob once no file references it; the refcount guard keeps it if an
+    # upload referenced it again in the meantime
+    db.execute(
+        update(models.Blob)
+        .where(models.Blob.id == blob.id)
+        .values(refcount=models.Blob.refcount - 1)
+    )
+    blob_unreferenced = db.execute(
+        delete(models.Blob)
+        .where(models.Blob.id == blob.id, models.Blob.refcount == 0)
+    ).rowcount > 0
 
 
-    # Remove blob if no one has it
-    if db.query(models.File).filter_by(file_hash=file.file_hash).count() == 0:
+    # Remove blob file if no one has it, while the write lock still keeps uploads of
+    # the same content from re-creating the blob before this delete commits
+    if blob_unreferenced:
+        blob_path = get_blob_path(blob.hash_bytes.hex())
         if os.path.exists(blob_path):
             os.remove(blob_path)
 
 
+    db.commit()
+
+    # Other copies may remain, so drop the entry and let the next upload re-check the DB
+    with _seen_hash_lock:
+        _seen_hash_cache.pop((username, blob.hash_bytes), None)
+
+
     return RedirectResponse("/upload", status_code=302)
 
 
@@ -562,17 +1008,14 @@ def delete_file(file_id: int, request: Request):
 
 # ---------------- PUBLIC SHARE ----------------
 @app.post("/share/{file_id}")
-def create_share(file_id: int, request: Request):
-    username = request.cookies.get("user")
+def create_share(file_id: int, request: Request, db: Session = Depends(get_db)):
+    username = helpers.unsign_username(request.cookies.get("user"))
     if not username:
         return RedirectResponse("/login")
 
 
-    db: Session = get_db()
-
-
     # Rate limiting
-    if not check_rate_limit(username, "share", db):
+    if not check_rate_limit(username, "share"):
         return RedirectResponse("/upload?upload_error=rate_limit", status_code=302)
 
 
@@ -600,13 +1043,12 @@ def create_share(file_id: int, request: Request):
 
 
 @app.post("/unshare/{file_id}")
-def revoke_share(file_id: int, request: Request):
-    username = request.cookies.get("user")
+def revoke_share(file_id: int, request: Request, db: Session = Depends(get_db)):
+    username = helpers.unsign_username(request.cookies.get("user"))
     if not username:
         return RedirectResponse("/login")
 
 
-    db: Session = get_db()
     file = db.query(models.File).filter_by(id=file_id, uploader=username).first()
     if not file:
         raise HTTPException(status_code=404)
@@ -621,8 +1063,7 @@ def revoke_share(file_id: int, request: Request):
 
 # ---------------- PUBLIC SHARE PAGE ----------------
 @app.get("/s/{share_token}", response_class=HTMLResponse)
-def public_share_page(share_token: str, request: Request):
-    db: Session = get_db()
+def public_share_page(share_token: str, request: Request, db: Session = Depends(get_db)):
     share = db.query(models.Share).filter_by(share_token=share_token, is_active=True).first()
     if not share:
         raise HTTPException(status_code=404)
@@ -643,23 +1084,25 @@ def public_share_page(share_token: str, request: Request):
 
 
 @app.get("/s/{share_token}/download")
-def public_download(share_token: str):
-    db: Session = get_db()
+def public_download(share_token: str, request: Request, background_tasks: BackgroundTasks, db: Session = Depends(get_db)):
     share = db.query(models.Share).filter_by(share_token=share_token, is_active=True).first()
     if not share:
         raise HTTPException(status_code=404)
-    file = db.query(models.File).filter_by(id=share.file_id).first()
-    if not file:
+    row = db.query(models.File, models.Blob).join(
+        models.Blob, models.Blob.id == models.File.blob_id
+    ).filter(models.File.id == share.file_id).first()
+    if not row:
         raise HTTPException(status_code=404)
+    file, blob = row
 
 
-    blob_path = os.path.join(UPLOAD_DIR, file.file_hash)
-    if not os.path.exists(blob_path):
-        raise HTTPException(status_code=404)
+    response = blob_response(request, blob, file)
+    if response.status_code == 304:
+        return response
 
 
-    share.download_count += 1
-    db.commit()
+    # Single UPDATE so concurrent downloads can't lose increments
+    background_tasks.add_task(increment_download_count, share.id)
 
 
-    return FileResponse(blob_path, filename=file.filename)
+    return response
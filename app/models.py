@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, Boolean, DateTime
+from sqlalchemy import Column, Integer, String, Boolean, DateTime, Index, LargeBinary, ForeignKey
 from datetime import datetime
 from app.database import Base
 
@@ -13,6 +13,15 @@ class User(Base):
     storage_used = Column(Integer, default=0)  # Bytes used
 
 
+class Blob(Base):
+    __tablename__ = "blobs"
+
+    id = Column(Integer, primary_key=True, index=True)
+    hash_bytes = Column(LargeBinary(32), unique=True, index=True)  # raw content digest
+    size = Column(Integer)
+    refcount = Column(Integer, default=0)  # File rows pointing at this blob
+
+
 class File(Base):
     __tablename__ = "files"
 
@@ -20,11 +29,18 @@ class File(Base):
     filename = Column(String)
     uploader = Column(String)
     size = Column(Integer)
-    file_hash = Column(String)
+    blob_id = Column(Integer, ForeignKey("blobs.id"))
     is_duplicate = Column(Boolean)
     uploaded_at = Column(DateTime, default=datetime.utcnow, nullable=False)
     folder = Column(String, nullable=True)
 
+    __table_args__ = (
+        Index("ix_files_uploader_blob", "uploader", "blob_id"),
+        Index("ix_files_blob", "blob_id"),
+        Index("ix_files_uploader_dup", "uploader", "is_duplicate"),
+        Index("ix_files_folder", "folder"),
+    )
+
 
 class Share(Base):
     __tablename__ = "shares"
@@ -37,6 +53,10 @@ class Share(Base):
     is_active = Column(Boolean, default=True)
     download_count = Column(Integer, default=0)
 
+    __table_args__ = (
+        Index("ix_share_file_active", "file_id", "is_active"),
+    )
+
 
 class SharedFile(Base):
     __tablename__ = "shared_files"
@@ -47,6 +67,11 @@ class SharedFile(Base):
     shared_with = Column(String)
     shared_at = Column(DateTime, default=datetime.utcnow)
 
+    __table_args__ = (
+        Index("ix_shared_with", "shared_with"),
+        Index("ix_shared_file", "file_id"),
+    )
+
 
 class Folder(Base):
     __tablename__ = "folders"
@@ -56,11 +81,6 @@ class Folder(Base):
     owner = Column(String)
     created_at = Column(DateTime, default=datetime.utcnow)
 
-
-class RateLimit(Base):
-    __tablename__ = "rate_limits"
-
-    id = Column(Integer, primary_key=True, index=True)
-    username = Column(String, index=True)
-    endpoint = Column(String)
-    timestamp = Column(DateTime, default=datetime.utcnow, index=True)
+    __table_args__ = (
+        Index("ix_folders_owner_name", "owner", "name"),
+    )